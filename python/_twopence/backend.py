@@ -43,3 +43,7 @@ class Backend(Configurable):
 
 	def destroyVolume(self, volumeID):
 		pass
+
+	# Wait for any work the backend does in the background
+	def close(self):
+		pass
@@ -54,14 +54,15 @@ class GenericInstance(PersistentTestInstance):
 		# If the instance workspace exists already, we should fail.
 		# However, it may be a leftover from an aborted attempt.
 		# Try to be helpful and remove the workspace IFF it is empty
-		if os.path.isdir(path):
-			try:	os.rmdir(path)
-			except: pass
+		try:
+			os.makedirs(path)
+		except FileExistsError:
+			try:
+				os.rmdir(path)
+				os.makedirs(path)
+			except OSError:
+				raise ValueError(f"workspace {path} already exists")
 
-		if os.path.isdir(path):
-			raise ValueError(f"workspace {path} already exists")
-
-		os.makedirs(path)
 		return path
 
 	def workspacePath(self, name):
@@ -70,7 +71,18 @@ class GenericInstance(PersistentTestInstance):
 	def workspaceExists(self):
 		return os.path.exists(self.workspace)
 
-	def removeWorkspace(self):
+	# If an executor is given, the workspace is moved out of the way and
+	# removed in the background; callers only wait for the rename.
+	def removeWorkspace(self, executor = None):
+		if executor is not None and os.path.exists(self.workspace):
+			doomed = "%s.deleting.%d" % (self.workspace, os.getpid())
+			try:
+				os.rename(self.workspace, doomed)
+				executor.submit(shutil.rmtree, doomed, ignore_errors = True)
+			except OSError as e:
+				debug("Cannot rename %s: %s" % (self.workspace, e))
+
+		# Either no executor, or the rename failed
 		if os.path.exists(self.workspace):
 			shutil.rmtree(self.workspace)
 		self.exists = False
@@ -235,6 +247,16 @@ class GenericInstance(PersistentTestInstance):
 				for line in status.output:
 					print(line, file = f)
 
+	# Same as saveExecStatus, but for a command whose output is being
+	# streamed. Lines are written to the log as the caller consumes them.
+	def teeExecStatus(self, filename, status):
+		with self.openLog(filename) as f:
+			print("Command output follows", file = f)
+			for line in status.output:
+				print(line, file = f)
+				yield line
+			print("%s %s" % (time.ctime(), status), file = f)
+
 	def openLog(self, filename):
 		path = os.path.join(self.workspace, filename)
 		return open(path, "w")
@@ -196,7 +196,15 @@ class TopologyStatus(Configurable):
 			os.makedirs(parent_dir)
 
 		debug("Saving status to %s" % self.path)
-		self.publishToPath(self.path)
+
+		# Write to a temporary file first and rename it into place, so
+		# that a crash half-way through never leaves us with a truncated
+		# status.conf
+		tmp_path = self.path + ".tmp"
+		self.publishToPath(tmp_path)
+		with open(tmp_path, "rb") as f:
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path)
 
 		if False:
 			print("-- contents of %s --" % self.path)
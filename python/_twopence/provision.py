@@ -110,6 +110,51 @@ class ProvisioningShellEnvironment:
 		return iter(self._env)
 
 class Provisioner:
+	def __init__(self):
+		# compiled templates, keyed by path
+		self._templates = {}
+
+	# Templates are parsed once and cached until they change on disk.
+	# Each line of a template is turned into a list of segments, where
+	# a segment is either a literal string, or a (key, rest) tuple for
+	# a @KEY@ reference, with rest being the raw remainder of the line.
+	def getCompiledTemplate(self, templatePath):
+		mtime = os.stat(templatePath).st_mtime_ns
+
+		cached = self._templates.get(templatePath)
+		if cached is not None and cached[0] == mtime:
+			return cached[1]
+
+		compiled = []
+		with open(templatePath, "r") as tmpf:
+			lineNumber = 0
+			for line in tmpf.readlines():
+				lineNumber += 1
+
+				segments = []
+				while '@' in line:
+					i = line.index('@')
+					segments.append(line[:i])
+
+					line = line[i+1:]
+					i = line.find('@')
+					if i < 0:
+						raise ValueError("lone @ in %s:%d" % (templatePath, lineNumber))
+
+					if i == 0:
+						# @@ is written out as @
+						segments.append('@')
+					else:
+						segments.append((line[:i], line[i+1:]))
+
+					line = line[i+1:]
+
+				segments.append(line)
+				compiled.append((lineNumber, segments))
+
+		self._templates[templatePath] = (mtime, compiled)
+		return compiled
+
 	def processTemplate(self, nodeConfig, templatePath, outputPath, extraData = None):
 		if not templatePath.startswith('/'):
 			templatePath = os.path.join("/usr/lib/twopence/provision", templatePath)
@@ -118,28 +163,17 @@ class Provisioner:
 
 		data = self.nodeConfigAsDict(nodeConfig, extraData)
 
-		tmpf = open(templatePath, "r")
-		outf = open(outputPath, "w")
-
-		lineNumber = 0
-		for line in tmpf.readlines():
-			lineNumber += 1
+		compiled = self.getCompiledTemplate(templatePath)
 
-			output = ""
-			while '@' in line:
-				i = line.index('@')
-				output += line[:i]
+		with open(outputPath, "w") as outf:
+			for lineNumber, segments in compiled:
+				output = ""
+				for seg in segments:
+					if type(seg) == str:
+						output += seg
+						continue
 
-				line = line[i+1:]
-				i = line.find('@')
-				if i < 0:
-					raise ValueError("lone @ in %s:%d" % (templatePath, lineNumber))
-
-				if i == 0:
-					# @@ is written out as @
-					output += '@'
-				else:
-					key = line[:i]
+					key, rest = seg
 
 					value = data.get(key)
 					if value is None:
@@ -154,15 +188,12 @@ class Provisioner:
 							value = ""
 						else:
 							for l in value[:-1]:
-								outf.write(output + l + line[i+1:])
+								outf.write(output + l + rest)
 							value = value[-1]
 
 					output += value
 
-				line = line[i+1:]
-
-			output += line
-			outf.write(output)
+				outf.write(output)
 
 	def nodeConfigAsDict(self, nodeConfig, extraData, list_sepa = " "):
 		d = {}
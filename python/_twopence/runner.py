@@ -7,6 +7,12 @@
 ##################################################################
 
 import subprocess
+import shlex
+import threading
+import signal
+import select
+import codecs
+import os
 import time
 from .util import ProgressBar
 
@@ -15,6 +21,7 @@ class CommandTimeout(Exception):
 
 class Alarm:
 	active = None
+	expired = False
 
 	def __init__(self, timeout):
 		from signal import alarm, signal, SIGALRM, SIG_DFL
@@ -44,6 +51,77 @@ class Alarm:
 			self._alarm(0)
 			Alarm.active = None
 
+# Kill a command we started. For shell commands, this kills the entire
+# process group, because the shell may have children that hold on to the
+# output pipe. The command must have been started in a session of its
+# own for this.
+def killProcess(process, group = False):
+	try:
+		if group:
+			os.killpg(process.pid, signal.SIGKILL)
+		else:
+			process.kill()
+	except ProcessLookupError:
+		pass
+
+# SIGALRM is always delivered to the main thread, so Alarm cannot be used
+# to time out commands executed from a worker thread. Instead, kill the
+# command from a timer thread; the reader then stops reading.
+class Watchdog:
+	def __init__(self, timeout, process, group = False):
+		self.expired = False
+		self._process = process
+		self._group = group
+		self._timer = None
+
+		if timeout:
+			self._timer = threading.Timer(timeout, self.expire)
+			self._timer.daemon = True
+			self._timer.start()
+
+	def expire(self):
+		self.expired = True
+		killProcess(self._process, self._group)
+
+	def cancel(self):
+		if self._timer is not None:
+			self._timer.cancel()
+			self._timer = None
+
+# Read the output of a command line by line. We do not block in readline(),
+# because a child that the command left behind (a background job, say) may
+# hold on to the pipe long after the command itself has exited, or was
+# killed by the watchdog. Instead, we stop reading as soon as the command
+# is gone and there is no more output waiting for us.
+def readLines(process, alarm, interval = 0.5):
+	fd = process.stdout.fileno()
+	decoder = codecs.getincrementaldecoder("utf8")(errors = "replace")
+	partial = ""
+
+	while not alarm.expired:
+		# Check whether the command has exited before looking at the
+		# pipe, so that we don't miss any output it wrote before exiting
+		exited = process.poll() is not None
+
+		ready, _, _ = select.select([fd], [], [], 0 if exited else interval)
+		if not ready:
+			if exited:
+				break
+			continue
+
+		data = os.read(fd, 4096)
+		if not data:
+			break
+
+		lines = (partial + decoder.decode(data)).split("\n")
+		partial = lines.pop()
+		for l in lines:
+			yield l
+
+	partial += decoder.decode(b"", final = True)
+	if partial:
+		yield partial
+
 class ExecStatus:
 	RUNNING = 0
 	TIMED_OUT = 1
@@ -74,6 +152,13 @@ class ExecStatus:
 	def running(klass, *args, **kwargs):
 		return klass(klass.RUNNING, *args, **kwargs)
 
+	# Stop a streaming command whose output the caller isn't going to
+	# read any further. This is a no-op once the output has been consumed.
+	def close(self):
+		close = getattr(self.output, 'close', None)
+		if close is not None:
+			close()
+
 	def __bool__(self):
 		return self.exit_code == 0
 
@@ -90,44 +175,106 @@ class ExecStatus:
 		return "UNKNOWN"
 
 class Runner:
-	def run(self, command, cwd = None, timeout = 10, quiet = False, abandonOnString = None):
+	# Run a shell command and collect its output.
+	# With stream = True, the command is started lazily and status.output
+	# is an iterator that yields lines as the command produces them. The
+	# exit status becomes available once the output has been consumed.
+	def run(self, command, cwd = None, timeout = 10, quiet = False, abandonOnString = None, stream = False):
+		status = ExecStatus.running(output = [])
+		status.output = self.execute(status, command, cwd, timeout, quiet, abandonOnString, stream)
+		if not stream:
+			status.output = list(status.output)
+		return status
+
+	def execute(self, status, command, cwd, timeout, quiet, abandonOnString, stream):
+		# The command may be given as a string, which is passed to the
+		# shell, or as an argv list, which is executed directly.
+		useShell = isinstance(command, str)
+		if useShell:
+			display = command
+		else:
+			display = shlex.join(command)
+
 		if cwd:
-			print("Executing \"%s\" in directory %s" % (command, cwd))
+			print("Executing \"%s\" in directory %s" % (display, cwd))
 		else:
-			print("Executing \"%s\"" % command)
+			print("Executing \"%s\"" % display)
+
+		# When streaming, the caller's code runs between the lines we read,
+		# so we can't have SIGALRM raise an exception in there.
+		useAlarm = not stream and threading.current_thread() is threading.main_thread()
+
+		# Without SIGALRM, the watchdog has to kill shell commands along
+		# with their children, which requires a process group of their own.
+		# Commands we exec directly do not need this, and should stay in our
+		# group so that they see a Ctrl-C from the terminal.
+		newSession = useShell and not useAlarm
 
+		# Commands never get any input from us; don't let them
+		# wait for input from the terminal either
 		p = subprocess.Popen(command,
 				cwd = cwd,
-				encoding = "utf8",
+				stdin = subprocess.DEVNULL,
 				stdout = subprocess.PIPE,
 				stderr = subprocess.STDOUT,
-				shell = True,
+				shell = useShell,
+				start_new_session = newSession,
 				bufsize = 0)
 
 		startTime = time.time()
-		alarm = Alarm(timeout)
-		output = []
-
-		while p.poll() is None:
-			try:
-				l = p.stdout.readline().strip()
-				if not quiet:
-					if len(output) == 0:
-						print("Command output:")
-
-					print("[%s] %s" % (self.formatTimestamp(startTime), l))
-				output.append(l)
-				if abandonOnString and abandonOnString in l:
-					alarm.cancel()
-					return ExecStatus.running(output)
-			except CommandTimeout:
-				print("[%s] Command Timed Out." % (self.formatTimestamp(startTime), ))
-				p.kill()
-				return ExecStatus.timedOut(output)
-
-		alarm.cancel()
-
-		return ExecStatus.exited(p.returncode, output)
+		if useAlarm:
+			alarm = Alarm(timeout)
+		else:
+			alarm = Watchdog(timeout, p, group = newSession)
+		nlines = 0
+		abandoned = False
+		lines = readLines(p, alarm)
+
+		try:
+			while True:
+				try:
+					l = next(lines, None)
+					if l is None:
+						break
+
+					l = l.strip()
+					if not quiet:
+						if nlines == 0:
+							print("Command output:")
+
+						print("[%s] %s" % (self.formatTimestamp(startTime), l))
+					nlines += 1
+					yield l
+
+					if abandonOnString and abandonOnString in l:
+						# leave the status at RUNNING
+						abandoned = True
+						return
+				except CommandTimeout:
+					print("[%s] Command Timed Out." % (self.formatTimestamp(startTime), ))
+					p.kill()
+					status.how = ExecStatus.TIMED_OUT
+					return
+
+			p.wait()
+		finally:
+			alarm.cancel()
+
+			# If our caller stopped reading early (because of an exception,
+			# or by closing the generator), do not leave the command running
+			if not abandoned:
+				if p.poll() is None:
+					killProcess(p, newSession)
+					p.wait()
+				p.stdout.close()
+
+		if alarm.expired:
+			print("[%s] Command Timed Out." % (self.formatTimestamp(startTime), ))
+			status.how = ExecStatus.TIMED_OUT
+			return
+
+		status.how = ExecStatus.EXITED
+		status.exit_code = p.returncode
 
 	def formatTimestamp(self, since):
 		elapsed = time.time() - since
@@ -144,9 +291,12 @@ class Runner:
 		else:
 			print("Executing \"%s\"" % command)
 
+		# Commands never get any input from us; don't let them
+		# wait for input from the terminal either
 		p = subprocess.Popen(command,
 				cwd = cwd,
 				encoding = "utf8",
+				stdin = subprocess.DEVNULL,
 				stdout = subprocess.PIPE,
 				stderr = subprocess.STDOUT,
 				shell = True)
@@ -379,7 +379,7 @@ class RuntimeVolumeLoop(RuntimeVolume):
 		imgsize = self.size or "1G"
 
 		name = self.mountpoint.replace(os.path.sep, '-')
-		path = os.path.join(instance.workspace, f"image{name}")
+		path = instance.workspacePath(f"image{name}")
 
 		self.makeEmptyImage(path, imgsize)
 
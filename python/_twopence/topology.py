@@ -240,6 +240,9 @@ class TestTopology(PersistentTestTopology):
 			self.saveStatus()
 		self.instances = []
 
+		# Workspaces may still be being removed in the background
+		self.backend.close()
+
 	def cleanup(self):
 		self.cleanupStatus()
 
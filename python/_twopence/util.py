@@ -40,16 +40,21 @@ class ProgressBar:
 			self.printed = False
 
 class DottedNumericVersion:
+	__slots__ = ('_value', '_parsed')
+
 	def __init__(self, version_string):
 		self._value = version_string
 		if version_string is None:
-			self._parsed = []
+			self._parsed = ()
 		else:
-			self._parsed = [int(_) for _ in version_string.split('.')]
+			self._parsed = tuple(int(_) for _ in version_string.split('.'))
 
 	def __str__(self):
 		return str(self._value)
 
+	def as_tuple(self):
+		return self._parsed
+
 	def __eq__(self, other):
 		return self._value == other._value
 	def __ne__(self, other):
@@ -86,4 +91,4 @@ class DottedNumericVersion:
 
 			return a - b
 
-		return len(A) - len(B)
+		return len(self._parsed) - len(other._parsed)
@@ -6,10 +6,17 @@
 #
 ##################################################################
 import os
+import csv
 import json
-import shutil
-import copy
+import shlex
+import string
 import time
+import functools
+import operator
+import hashlib
+import shutil
+import threading
+import concurrent.futures
 
 from twopence import ConfigError
 from .logging import *
@@ -17,9 +24,59 @@ from .backend import Backend
 from .runner import Runner
 from .instance import *
 from .provision import *
-from .config import Config, Configurable, Schema
+from .config import Config, Configurable, Schema, IntegerAttributeSchema
 from .util import DottedNumericVersion
 
+# Use orjson for box meta data if it's available; the stdlib json
+# module will do otherwise.
+try:
+	import orjson
+
+	_json_loads = orjson.loads
+
+	def _json_dumps(obj):
+		return orjson.dumps(obj, option = orjson.OPT_INDENT_2)
+except ImportError:
+	_json_loads = json.loads
+
+	def _json_dumps(obj):
+		return json.dumps(obj, indent = 4).encode('utf-8')
+
+# Large local meta files are parsed incrementally if ijson is available
+try:
+	import ijson
+
+	_MetaParseErrors = (ValueError, OSError, ijson.JSONError)
+except ImportError:
+	ijson = None
+	_MetaParseErrors = (ValueError, OSError)
+
+VagrantCacheDir = "~/.twopence/cache"
+VagrantBoxListCache = "vagrant_boxlist.json"
+VagrantBoxIndexCache = "box_index.json"
+VagrantCloudCacheTTL = 900
+VagrantGlobalStatusTTL = 5
+VagrantBoxDownloadCache = "boxes"
+VagrantBoxDownloadCacheSize = 8192
+VagrantMetaStreamThreshold = 64 * 1024
+
+# Error messages that indicate that a failed vagrant command
+# may succeed when retried
+_VagrantTransientErrors = (
+	'Failed to connect socket',
+	'Call to virDomain',
+	'lock',
+	'timeout',
+)
+
+# Maps the record types of "vagrant box list --machine-readable"
+# to the VagrantBoxInfo attributes they describe
+_BoxListFields = {
+	'box-name':		'name',
+	'box-version':		'version',
+	'box-provider':		'provider',
+}
+
 VagrantRebootBlock = '''
   config.vm.provision :shell do |shell|
     shell.privileged = true
@@ -35,6 +92,60 @@ VagrantShellTrailer = '''
   SHELL
 '''
 
+# A shell provisioning block. Note that substitute() does not look at
+# the body, so the shell script may contain $ signs as it pleases.
+VagrantShellTemplate = string.Template(VagrantShellHeader + "${body}" + VagrantShellTrailer)
+
+# vagrant's machine-readable output escapes commas inside a field
+def unescapeMachineReadable(value):
+	return value.replace('%!(VAGRANT_COMMA)', ',')
+
+# The key by which box versions are compared. The same few version
+# strings show up over and over again, so remember what we parsed.
+@functools.lru_cache(maxsize = 1024)
+def versionKey(value):
+	return DottedNumericVersion(value).as_tuple()
+
+def getCachePath(*names):
+	return os.path.join(os.path.expanduser(VagrantCacheDir), *names)
+
+# All our HTTP requests (to vagrantcloud, or for downloading boxes) go
+# through one session, so that we can reuse the HTTPS connection rather
+# than doing a TLS handshake for every request. requests is imported
+# only when we actually need it.
+_httpSession = None
+_httpSessionLock = threading.Lock()
+
+def getHTTPSession():
+	global _httpSession
+
+	with _httpSessionLock:
+		if _httpSession is None:
+			import requests
+			import requests.adapters
+
+			session = requests.Session()
+			session.headers['User-Agent'] = 'twopence-provision'
+			session.mount('https://', requests.adapters.HTTPAdapter(pool_connections = 4, pool_maxsize = 8))
+			_httpSession = session
+
+	return _httpSession
+
+# Write a cache file atomically, so that concurrent readers never
+# see a partially written file
+def writeCacheFile(path, obj):
+	tmpPath = "%s.%d.tmp" % (path, os.getpid())
+	try:
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		with open(tmpPath, "wb") as f:
+			f.write(_json_dumps(obj))
+		os.replace(tmpPath, path)
+	except OSError as e:
+		warning("Unable to write cache file %s: %s" % (path, e))
+		return False
+
+	return True
+
 class VagrantBoxInfo:
 	ORIGIN_LOCAL = "local"
 	ORIGIN_REMOTE = "remote"
@@ -42,26 +153,52 @@ class VagrantBoxInfo:
 
 	def __init__(self, name = None, version = None, provider = None, url = None, origin = None):
 		self.name = name
-		self._version = DottedNumericVersion(version)
+		self.version = version
 		self.provider = provider
 		self.url = url
 		self.origin = origin or self.ORIGIN_LOCAL
 
+	# The version is also kept as a tuple of ints, which is what
+	# comparisons use
 	@property
 	def version(self):
-		return str(self._version)
+		return self._versionString
 
 	@version.setter
 	def version(self, value):
-		self._version = DottedNumericVersion(value)
+		self._versionString = value
+		self._key = versionKey(value)
+
+	@property
+	def origin(self):
+		return self._origin
+
+	@origin.setter
+	def origin(self, value):
+		self._origin = value
+		self._isLocal = (value == self.ORIGIN_LOCAL)
 
 	@property
 	def isLocal(self):
-		return self.origin == self.ORIGIN_LOCAL
+		return self._isLocal
 
 	def __str__(self):
 		return "vagrant image %s/%s (origin %s)" % (self.name, self.version, self.origin)
 
+	# Copy the box, replacing some of its attributes. The version is
+	# passed on as is rather than being parsed again.
+	def clone(self, **overrides):
+		result = VagrantBoxInfo(name = self.name,
+				provider = self.provider,
+				url = self.url,
+				origin = self.origin)
+		result._versionString = self._versionString
+		result._key = self._key
+
+		for attr, value in overrides.items():
+			setattr(result, attr, value)
+		return result
+
 	# practically the same, except for the version
 	def similar(self, other):
 		if not isinstance(other, self.__class__):
@@ -70,38 +207,35 @@ class VagrantBoxInfo:
 		if self.name != other.name:
 			return False
 
-		if self.origin == other.origin:
-			return True
-
 		# A local and a remote image always match
-		if self.isLocal or other.isLocal:
-			return True
-
-		return False
+		return self._origin == other._origin or self._isLocal or other._isLocal
 
+	# The version check is done first, as it's the one most likely
+	# to tell two boxes apart
 	def __eq__(self, other):
-		if not self.similar(other):
-			return False
-		return self._version == other._version
+		return isinstance(other, VagrantBoxInfo) and self._key == other._key and self.similar(other)
 
 	def __lt__(self, other):
-		if not self.similar(other):
-			return False
-		return self._version < other._version
+		return isinstance(other, VagrantBoxInfo) and self._key < other._key and self.similar(other)
 
 	def __le__(self, other):
-		if not self.similar(other):
-			return False
-		return self._version <= other._version
+		return isinstance(other, VagrantBoxInfo) and self._key <= other._key and self.similar(other)
 
 class VagrantBoxMeta:
-	def __init__(self, name, url = None, provider = "libvirt"):
+	def __init__(self, name, url = None, provider = "libvirt", data = None):
 		self.name = name
 		self.base_url = url
 		self.origin = None
 		self.provider = provider
 		self.downloadUrl = None
-		self.boxes = []
+
+		# latest box per provider, updated as boxes get added
+		self._latest = {}
+
+		# (version, url) of the boxes listed in the meta data. Most of
+		# the time, all we need is the latest of these, so we create
+		# VagrantBoxInfo objects only when asked to.
+		self._pending = []
 
 		if url.startswith("vagrant:"):
 			self.origin = VagrantBoxInfo.ORIGIN_VAGRANTCLOUD
@@ -115,13 +249,15 @@ class VagrantBoxMeta:
 			data = self.tryVagrantCloud(remote)
 			if data is None:
 				verbose("unable to retrieve image from \"%s\" - faking it" % url)
+				data = {}
 
 			self.downloadUrl = remote
 		elif url.startswith("/"):
 			self.origin = VagrantBoxInfo.ORIGIN_LOCAL
 
 			debug("URL %s refers to local image" % url)
-			data = self.tryLocal(url)
+			if data is None:
+				data = self.tryLocal(url)
 			if data is None:
 				return None
 
@@ -146,55 +282,153 @@ class VagrantBoxMeta:
 				raise ConfigError("Image at %s does not provide a name" % url)
 			self.name = name
 
-		for version in data.get('versions') or []:
-			for actual_version in version.get('providers') or []:
-				self.addBox(version = version.get('version'),
-						provider = actual_version.get('name'),
-						url = actual_version.get('url')
-						)
+		# Vagrant cloud meta data can list dozens of versions for several
+		# providers each; we only care about the one we're going to use
+		provider = self.provider
+		for version in data.get('versions') or ():
+			providers = version.get('providers')
+			if not providers:
+				continue
+
+			versionString = version.get('version')
+			for actual_version in providers:
+				if actual_version.get('name') != provider:
+					continue
+
+				self._pending.append((versionString, actual_version.get('url')))
 
 	@staticmethod
-	def load(name, url):
+	def load(name, url, data = None):
 		debug("VagrantBoxMeta.load(%s, %s)" % (name, url))
-		return VagrantBoxMeta(name, url)
+		meta = VagrantBoxMeta(name, url, data = data)
+
+		# We were unable to read a local meta file
+		if meta.downloadUrl is None:
+			return None
+
+		return meta
 
 	def addBox(self, **kwargs):
 		box = VagrantBoxInfo(self.name, **kwargs, origin = self.origin)
-		self.boxes.append(box)
+
+		best = self._latest.get(box.provider)
+		if best is None or best < box:
+			self._latest[box.provider] = box
 		return box
 
 	def getLatestVersion(self, provider = "libvirt"):
-		best = None
-		for box in self.boxes:
-			if box.provider != provider:
-				continue
-			if best is None or best < box:
-				best = box
-		return best
+		# Pick the latest version without creating a box for every
+		# entry. On a tie, the first one wins, just like in addBox()
+		if self._pending and provider == self.provider and provider not in self._latest:
+			version, url = max(self._pending, key = lambda e: versionKey(e[0]))
+			self._latest[provider] = VagrantBoxInfo(self.name,
+						version = version,
+						provider = provider,
+						url = url,
+						origin = self.origin)
+
+		return self._latest.get(provider)
+
+	# Condense the meta data to the latest box per provider, using
+	# the same format as the meta file itself
+	def getSummary(self):
+		self.getLatestVersion(self.provider)
+
+		versions = []
+		for box in self._latest.values():
+			versions.append({
+				'version': box.version,
+				'providers': [
+					{
+						'name': box.provider,
+						'url': box.url,
+					}
+				]
+			})
+		return {'name': self.name, 'versions': versions}
 
 	def getDownloadFor(self, box):
 		if self.downloadUrl:
-			box = copy.copy(box)
-			box.url = self.downloadUrl
+			box = box.clone(url = self.downloadUrl)
 		return box
 
 	def tryLocal(self, url):
 		if not os.path.isfile(url):
 			return None
 
-		with open(url) as f:
-			try:
-				data = json.load(f)
-			except:
-				return None
+		# An empty or truncated file is not worth parsing
+		size = os.path.getsize(url)
+		if size < 2:
+			warning("Ignoring truncated image meta data in %s" % url)
+			return None
+
+		try:
+			with open(url, "rb") as f:
+				if ijson is not None and size >= VagrantMetaStreamThreshold:
+					data = self.streamLocal(f)
+				else:
+					data = _json_loads(f.read())
+		except _MetaParseErrors as e:
+			warning("Failed to parse %s: %s" % (url, e))
+			return None
 
 		return data
 
+	# Pick only what we need out of a large meta file, rather than
+	# building the whole document in memory. The result looks like
+	# the meta data, minus the boxes for other providers.
+	def streamLocal(self, f):
+		name = next(ijson.items(f, 'name'), None)
+		f.seek(0)
+
+		versions = []
+		for version in ijson.items(f, 'versions.item'):
+			providers = [p for p in version.get('providers') or () if p.get('name') == self.provider]
+			if providers:
+				versions.append({'version': version.get('version'), 'providers': providers})
+
+		return {'name': name, 'versions': versions}
+
+	# Responses from vagrantcloud are cached in ~/.twopence/cache/vagrantcloud.
+	# A cached response younger than VagrantCloudCacheTTL is used as-is;
+	# an older one is revalidated with a conditional GET.
 	def tryVagrantCloud(self, name):
-		import requests
+		cachePath = getCachePath("vagrantcloud", name.replace('/', '_') + ".json")
+		cached = self.loadCloudResponse(cachePath)
+		if cached is not None and time.time() - cached['mtime'] < VagrantCloudCacheTTL:
+			debug("Using cached vagrantcloud response for %s" % name)
+			return cached['data']
+
+		headers = {}
+		if cached is not None:
+			if cached.get('etag'):
+				headers['If-None-Match'] = cached['etag']
+			if cached.get('last_modified'):
+				headers['If-Modified-Since'] = cached['last_modified']
 
 		url = "https://vagrantcloud.com/%s" % name
-		resp = requests.get(url)
+		try:
+			# Give up quickly if we can't even connect; with the cache
+			# to fall back on, that's better than hanging around
+			resp = getHTTPSession().get(url, headers = headers, timeout = (3.05, 10))
+		except OSError as e:
+			# this includes the exceptions raised by requests
+			if cached is None:
+				warning("Failed to download %s: %s" % (url, e))
+				return None
+
+			warning("Unable to reach vagrantcloud (%s); using cached data for %s" % (e, name))
+			return cached['data']
+
+		if resp.status_code == 304 and cached is not None:
+			debug("Cached vagrantcloud response for %s is still valid" % name)
+			os.utime(cachePath)
+			return cached['data']
+
+		if resp.status_code >= 500 and cached is not None:
+			warning("vagrantcloud failed to respond (%s); using cached data for %s" % (resp.reason, name))
+			return cached['data']
+
 		if not resp.ok:
 			warning("Failed to download %s: %s" % (url, resp.reason))
 			return None
@@ -204,48 +438,91 @@ class VagrantBoxMeta:
 			warning("Bad content type from %s: %s" % (url, content_type))
 			return None
 
-		return resp.json()
+		try:
+			data = _json_loads(resp.content)
+		except ValueError as e:
+			warning("Bad response from %s: %s" % (url, e))
+			return None
+
+		writeCacheFile(cachePath, {
+			'etag': resp.headers.get('etag'),
+			'last_modified': resp.headers.get('last-modified'),
+			'data': data,
+		})
+		return data
+
+	def loadCloudResponse(self, path):
+		try:
+			with open(path, "rb") as f:
+				cached = _json_loads(f.read())
+				cached['mtime'] = os.fstat(f.fileno()).st_mtime
+		except (OSError, ValueError):
+			return None
+
+		return cached
 
 class VagrantBoxListing:
 	def __init__(self):
 		self.boxes = []
 
-	def create(self):
-		box = VagrantBoxInfo()
+		# boxes indexed by (name, provider), plus the set of
+		# (name, provider, version) keys for membership tests
+		self._index = {}
+		self._keys = set()
+
+	def add(self, name = None, version = None, provider = None):
+		# 0 means no version provided
+		if version == "0":
+			version = None
+
+		box = VagrantBoxInfo(name = name, version = version, provider = provider)
 		self.boxes.append(box)
+		self._index.setdefault((name, provider), []).append(box)
+		self._keys.add((name, provider, box._key))
 		return box
 
+	# The listing in the form we keep in the cache
+	def getRecords(self):
+		return [{'name': box.name, 'version': box.version, 'provider': box.provider} for box in self.boxes]
+
 	def find(self, name, provider = "libvirt", version = None):
-		for box in self.boxes:
-			if version is not None and box.version != version:
-				continue
-			if box.name == name and box.provider == provider:
+		for box in self._index.get((name, provider), ()):
+			if version is None or box.version == version:
 				return box
 		return None
 
 	def __contains__(self, wanted):
+		# All boxes in the listing are local, and a local box is
+		# similar() to any box by the same name. So equality boils
+		# down to comparing name and version.
 		if wanted is None:
 			return False
-		for box in self.boxes:
-			if box == wanted:
-				return True
-		return False
+		return (wanted.name, wanted.provider, wanted._key) in self._keys
 
 
 class VagrantInstance(GenericInstance):
+	# Map the raw state reported by "vagrant status" to whether
+	# the VM is running or not
+	runningStates = {
+		'preparing':	True,
+		'running':	True,
+		'not_started':	False,
+		'shutoff':	False,
+		'not_created':	False,
+	}
+
 	def setStateFromVagrantStatus(self, raw_status):
 		# debug("setStateFromVagrantStatus(%s, raw=%s, persistent=%s)" % (self.name, raw_status, self.persistent))
-		if raw_status in ('preparing', 'running', ):
-			self.running = True
+		running = self.runningStates.get(raw_status)
+		if running is None:
+			raise ValueError("Vagrant instance %s/default is in state %s - huh?!" % (
+					self.name, raw_status))
 
+		self.running = running
+		if running:
 			self.fetchNeworksFromPersistentState()
-		elif raw_status in ('not_started', 'shutoff', 'not_created'):
-			self.running = False
-
-			self.clearNetworkInterfaces()
 		else:
-			raise ValueError("Vagrant instance %s/default is in state %s - huh?!" % (
-					self.name, raw_status))
+			self.clearNetworkInterfaces()
 
 		self.raw_state = raw_status
 
@@ -268,6 +545,11 @@ class VagrantBackend(Backend):
 	schema = [
 		Schema.StringAttribute('template'),
 		Schema.FloatAttribute('timeout', default_value = 120),
+		IntegerAttributeSchema('max_workers', 'max-workers', default_value = 8),
+		IntegerAttributeSchema('retries', default_value = 3),
+		Schema.FloatAttribute('retry_backoff', 'retry-backoff', default_value = 0.5),
+		# in MiB
+		IntegerAttributeSchema('box_cache_size', 'box-cache-size', default_value = VagrantBoxDownloadCacheSize),
 	]
 
 	def __init__(self):
@@ -280,6 +562,39 @@ class VagrantBackend(Backend):
 		# the vagrant box listing
 		self.listing = None
 
+		# parsed box meta data (or None if it could not be loaded),
+		# keyed by (name, url, mtime)
+		self._metaCache = {}
+
+		# summary of local box meta files, loaded on demand
+		self._boxIndex = None
+
+		# output of vagrant global-status, and when we got it
+		self._globalStatus = None
+		self._globalStatusTime = 0
+
+		# Worker threads for running vagrant commands in parallel.
+		# This is created on first use, because max_workers is only
+		# known once the backend has been configured.
+		self._pool = None
+
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		pool = getattr(self, '_pool', None)
+		if pool is not None:
+			pool.shutdown()
+			self._pool = None
+
+	@property
+	def pool(self):
+		if self._pool is None:
+			self._pool = concurrent.futures.ThreadPoolExecutor(
+					max_workers = self.max_workers or 8,
+					thread_name_prefix = 'vagrant')
+		return self._pool
+
 	def attachNode(self, node):
 		# detect whether the node we want to provision/build has twopence enabled. If
 		# it does, we also enable "twopence-tcp", which configures
@@ -299,16 +614,121 @@ class VagrantBackend(Backend):
 		return VagrantInstance(self, instanceConfig, instanceWorkspace, persistentState)
 
 	def detect(self, topology, instances):
+		# Read the topology workspace once, rather than probing
+		# the workspace of every instance individually
+		workspaces = self.scanWorkspaces(topology.workspace)
+
+		# Not worth spinning up worker threads for a single instance,
+		# nor running "vagrant global-status" on top of its "vagrant status"
+		if len(instances) <= 1:
+			return [instance for instance in instances if self.detectInstance(instance, workspaces)]
+
+		# A single "vagrant global-status" tells us which of the machines
+		# vagrant knows about are down
+		globalStatus = None
+		if workspaces:
+			globalStatus = self.loadGlobalStatus()
+
+		# Instances that the global status does not report as down need
+		# a "vagrant status" each, which is slow but independent of the
+		# other instances.
+		# Run them in parallel.
+		futures = [self.pool.submit(self.detectInstance, instance, workspaces, globalStatus) for instance in instances]
+
 		found = []
-		for instance in instances:
-			if self.detectInstance(instance):
+		for instance, future in zip(instances, futures):
+			if future.result():
 				found.append(instance)
 		return found
 
-	def detectInstance(self, instance):
+	def scanWorkspaces(self, path):
+		workspaces = set()
+		try:
+			with os.scandir(path) as it:
+				for e in it:
+					if not e.is_dir(follow_symlinks = False):
+						continue
+
+					if ".deleting." in e.name:
+						# If we crashed before we could finish removing
+						# this workspace, try again.
+						if self.isStaleDeletion(e.name):
+							debug("Removing leftover workspace %s" % e.path)
+							self.pool.submit(shutil.rmtree, e.path, ignore_errors = True)
+						continue
+
+					workspaces.add(e.path)
+		except FileNotFoundError:
+			pass
+
+		return workspaces
+
+	# removeWorkspace() renames a workspace to <name>.deleting.<pid>
+	# before removing it. If that process is gone, nobody else will
+	# clean up after it.
+	def isStaleDeletion(self, name):
+		(base, sep, pid) = name.rpartition(".deleting.")
+		if not sep or not pid.isdigit():
+			return False
+
+		pid = int(pid)
+		if pid == os.getpid():
+			return False
+
+		try:
+			os.kill(pid, 0)
+		except ProcessLookupError:
+			return True
+		except PermissionError:
+			pass
+		return False
+
+	# Returns a dict mapping the directory of each machine to its state.
+	# The output of "vagrant global-status --machine-readable" looks like this:
+	#  1638868423,default,machine-id,5a1b2c3
+	#  1638868423,default,provider-name,libvirt
+	#  1638868423,default,machine-home,/path/to/workspace
+	#  1638868423,default,state,running
+	#
+	# The result is reused for a few seconds, and dropped whenever we
+	# change the state of a VM ourselves.
+	def loadGlobalStatus(self):
+		if self._globalStatus is not None and \
+		   time.monotonic() - self._globalStatusTime < VagrantGlobalStatusTTL:
+			return self._globalStatus
+
+		status = self.runShellCmd(["vagrant", "global-status", "--prune", "--machine-readable"], quiet = True, timeout = 30)
+		if not status:
+			debug("vagrant global-status failed: %s" % status)
+			return {}
+
+		result = {}
+		home = None
+		for row in csv.reader(status.output, quoting = csv.QUOTE_NONE):
+			if len(row) < 4 or row[1] != 'default':
+				continue
+
+			what = row[2]
+			if what == 'machine-home':
+				home = os.path.realpath(unescapeMachineReadable(','.join(row[3:])))
+			elif what == 'state' and home is not None:
+				result[home] = unescapeMachineReadable(','.join(row[3:]))
+				home = None
+
+		self._globalStatus = result
+		self._globalStatusTime = time.monotonic()
+		return result
+
+	def dropGlobalStatus(self):
+		self._globalStatus = None
+
+	def detectInstance(self, instance, workspaces = None, globalStatus = None):
 		debug(f"detectInstance({instance.name})")
 
-		magic_path = os.path.join(instance.workspace, ".vagrant")
+		if workspaces is not None and instance.workspace not in workspaces:
+			return False
+
+		magic_path = instance.workspacePath(".vagrant")
 		if not os.path.isdir(magic_path):
 			return False
 
@@ -320,7 +740,7 @@ class VagrantBackend(Backend):
 		#   the node's persistent state
 		# - if no VM is running, clear instance.networkInterfaces and update
 		#   the node's persistent state (ie delete ipv4_address and friends)
-		self.detectInstanceState(instance)
+		self.detectInstanceState(instance, globalStatus)
 
 		debug("Detected instance %s (state %s)" % (instance.name, instance.raw_state))
 		return instance
@@ -333,9 +753,17 @@ class VagrantBackend(Backend):
 		# See if we have any version of that image
 		have = known.find(vagrantNode.image, version = None)
 
+		# If we have the image, and it's not a local build, we'd only go and
+		# check for a newer version when auto-updating. Don't bother loading
+		# the meta data (which may involve talking to vagrantcloud) otherwise.
+		url = vagrantNode.url
+		if have is not None and not self.auto_update and not (url and url.startswith("/")):
+			debug(f"We have {have}; not checking for updates")
+			return None
+
 		# If the image does not come with a .json meta file, check whether
 		# we have an unversioned image of that name
-		meta = VagrantBoxMeta.load(vagrantNode.image, vagrantNode.url)
+		meta = self.loadBoxMeta(vagrantNode.image, vagrantNode.url)
 		if meta is None:
 			if have:
 				debug("No need to download image %s; unversioned image already present" % (
@@ -344,6 +772,15 @@ class VagrantBackend(Backend):
 		else:
 			want = meta.getLatestVersion()
 
+			# We were unable to find out which versions are available
+			# (eg because vagrantcloud could not be reached). Use what we
+			# have, or let vagrant figure it out.
+			if want is None:
+				if have:
+					debug("No version information for %s; using %s" % (vagrantNode.image, have))
+					return None
+				return meta.getDownloadFor(VagrantBoxInfo(name = vagrantNode.image, provider = "libvirt"))
+
 			if want in known:
 				debug("No need to download %s; already present" % want)
 				return None
@@ -362,6 +799,66 @@ class VagrantBackend(Backend):
 
 		return VagrantBoxInfo(name = vagrantNode.image, url = vagrantNode.url, provider = "libvirt")
 
+	# Several instances of a topology usually share the same image, so
+	# avoid loading (and possibly downloading) its meta data repeatedly.
+	# Local meta files are reloaded when they change on disk.
+	def loadBoxMeta(self, name, url):
+		mtime = None
+		if url and url.startswith("/"):
+			try:
+				mtime = os.stat(url).st_mtime_ns
+			except OSError:
+				pass
+
+		# Note, this also caches failed lookups (as None)
+		key = (name, url, mtime)
+		if key in self._metaCache:
+			return self._metaCache[key]
+
+		if mtime is not None:
+			meta = self.loadIndexedBoxMeta(name, url, mtime)
+		else:
+			meta = VagrantBoxMeta.load(name, url)
+
+		self._metaCache[key] = meta
+		return meta
+
+	##################################################################
+	# For local box meta files, we keep a summary of each in
+	# ~/.twopence/cache/box_index.json, so that we do not have to
+	# open and parse every one of them on each run.
+	##################################################################
+	def loadIndexedBoxMeta(self, name, url, mtime):
+		index = self.loadBoxIndex()
+
+		entry = index.get(url)
+		if entry and entry.get('mtime_ns') == mtime:
+			debug("Using indexed meta data for %s" % url)
+			return VagrantBoxMeta.load(name, url, data = entry['meta'])
+
+		meta = VagrantBoxMeta.load(name, url)
+
+		# Do not record meta files we were unable to read
+		if meta is not None:
+			index[url] = {'mtime_ns': mtime, 'meta': meta.getSummary()}
+			self.saveBoxIndex()
+
+		return meta
+
+	def loadBoxIndex(self):
+		if self._boxIndex is None:
+			path = getCachePath(VagrantBoxIndexCache)
+			try:
+				with open(path, "rb") as f:
+					self._boxIndex = _json_loads(f.read())
+			except (OSError, ValueError):
+				self._boxIndex = {}
+
+		return self._boxIndex
+
+	def saveBoxIndex(self):
+		writeCacheFile(getCachePath(VagrantBoxIndexCache), self._boxIndex)
+
 	def downloadImage(self, instance):
 		download = self.identifyImageToDownload(instance.config)
 		if download:
@@ -374,9 +871,7 @@ class VagrantBackend(Backend):
 		if template is None:
 			raise ValueError("Cannot prepare vagrant instance - no template defined")
 
-		# this throws an exception in case of errors
-		instance.createWorkspace()
-
+		# Note, the instance workspace has been created by the caller
 		path = instance.workspacePath("Vagrantfile")
 
 		extraData = {}
@@ -401,41 +896,41 @@ class VagrantBackend(Backend):
 		self.provisioner.processTemplate(instance.config, template, path, extraData)
 		return instance
 
+	# Yields one config.vm.provision block per stage
 	def buildProvisioning(self, instanceConfig):
-		result = []
 		for s in instanceConfig.cookedStages():
-			formatted = ""
-
-			if s.reboot:
-				formatted += VagrantRebootBlock
-			formatted += VagrantShellHeader
 			# Do not indent the shell script; doing so breaks stuff
 			# like HERE scripts
-			formatted += s.format()
-			formatted += VagrantShellTrailer
-			result.append(formatted)
-
-		return result
+			block = VagrantShellTemplate.substitute(body = s.format())
+			if s.reboot:
+				block = VagrantRebootBlock + block
+			yield block
+
+	# The ruby variables set in the Vagrantfile, and the instanceConfig
+	# attribute they are taken from
+	machineConfigAttrs = (
+		("config.vm.box",		operator.attrgetter("vagrant.image")),
+		("config.vm.hostname",		operator.attrgetter("name")),
+		("config.ssh.private_key_path",	operator.attrgetter("keyfile")),
+		("twopence_platform",		operator.attrgetter("platform.name")),
+		("twopence_vendor",		operator.attrgetter("platform.vendor")),
+		("twopence_os",			operator.attrgetter("platform.os")),
+		("twopence_arch",		operator.attrgetter("platform.arch")),
+	)
 
 	def buildMachineConfig(self, instanceConfig):
-		def format_string_attr(ruby_var_name, attr_name):
-			object = instanceConfig
-			for n in attr_name.split('.'):
-				object = getattr(object, n, None)
-				if object is None:
-					return
-
-			assert(type(object) == str)
-			result.append("%s = '%s'" % (ruby_var_name, object))
-
 		result = []
-		format_string_attr("config.vm.box", "vagrant.image")
-		format_string_attr("config.vm.hostname", "name")
-		format_string_attr("config.ssh.private_key_path", "keyfile")
-		format_string_attr("twopence_platform", "platform.name")
-		format_string_attr("twopence_vendor", "platform.vendor")
-		format_string_attr("twopence_os", "platform.os")
-		format_string_attr("twopence_arch", "platform.arch")
+		for ruby_var_name, getter in self.machineConfigAttrs:
+			# An attribute that is missing or None anywhere along the
+			# path means there's nothing to set
+			try:
+				object = getter(instanceConfig)
+			except AttributeError:
+				continue
+
+			if object is not None:
+				assert(type(object) == str)
+				result.append("%s = '%s'" % (ruby_var_name, object))
 
 		return result
 
@@ -444,33 +939,49 @@ class VagrantBackend(Backend):
 			print("Cannot start instance %s - already running" % instance.name)
 			return False
 
+		self.dropGlobalStatus()
+
 		when = time.ctime()
 		timeout = instance.config.vagrant.timeout or 120
 
 		print("Starting %s instance (timeout = %d)" % (instance.name, timeout))
-		status = self.runShellCmd("vagrant --no-tty up", cwd = instance.workspace, timeout = timeout)
+		status = self.runShellCmd(["vagrant", "--no-tty", "up"], cwd = instance.workspace, timeout = timeout, stream = True)
+
+		# The markers we look for in the output of "vagrant up", and the
+		# functions that extract the information we want from those lines.
+		markers = {
+			"SSH address":	self.parseSSHAddress,
+		}
 
 		verbose("Saving output to vagrant_up.log")
-		instance.saveExecStatus("vagrant_up.log", status)
+		found = {}
+		lines = instance.teeExecStatus("vagrant_up.log", status)
+		try:
+			for line in lines:
+				# Once we have everything, just keep copying to the log
+				if len(found) == len(markers):
+					continue
+
+				for marker, parse in markers.items():
+					if marker in found or marker not in line:
+						continue
+
+					value = parse(line)
+					if value is not None:
+						found[marker] = value
+		finally:
+			# If we bail out early, make sure vagrant up does not
+			# keep running behind our back
+			lines.close()
+			status.close()
 
 		if status.exit_code != 0:
 			print("Cannot start instance %s - vagrant up failed (%s)" % (instance.name, status))
 			return False
 
-		import re
-
-		for line in status.output:
-			if "SSH address" not in line:
-				continue
-
-			m = re.match(".*SSH address[: ]*(\d+\.\d+\.\d+\.\d+):(\d+).*", line)
-			if m:
-				address = m.group(1)
-				verbose("Detected SSH address %s" % address)
-				instance.addNetworkInterface(Network.AF_IPv4, address)
-			else:
-				print("Bad: unable to parse address in output of \"vagrant up\"")
-				print("  ->> %s" % line.strip())
+		address = found.get("SSH address")
+		if address is not None:
+			instance.addNetworkInterface(Network.AF_IPv4, address)
 
 		# "default" is the name of the VM according to our Vagrantfile;
 		# "libvirt" is the name of the provider.
@@ -483,6 +994,28 @@ class VagrantBackend(Backend):
 		instance.start_time = when
 		return True
 
+	# The line we're looking at looks like this:
+	#  ==> default: SSH address: 192.168.121.42:22
+	def parseSSHAddress(self, line):
+		address = None
+
+		(prefix, sep, rest) = line.partition("SSH address")
+		words = rest.lstrip(": ").split(None, 1)
+		if words:
+			(address, sep, port) = words[0].partition(":")
+			octets = address.split(".")
+			if not sep or not port.isdigit() or len(octets) != 4 or \
+			   not all(o.isdigit() and len(o) <= 3 for o in octets):
+				address = None
+
+		if address is None:
+			print("Bad: unable to parse address in output of \"vagrant up\"")
+			print("  ->> %s" % line.strip())
+			return None
+
+		verbose("Detected SSH address %s" % address)
+		return address
+
 	def updateInstanceTarget(self, instance):
 		target = None
 
@@ -494,19 +1027,32 @@ class VagrantBackend(Backend):
 
 		instance.recordTarget(target)
 
-	def detectInstanceState(self, instance):
+	def detectInstanceState(self, instance, globalStatus = None):
+		# vagrant global-status is a cached index that can be out of date,
+		# so we only trust it to tell us a machine it knows about is down.
+		# If it claims the machine is running, or doesn't list it at all,
+		# ask vagrant status.
+		if globalStatus:
+			raw_state = globalStatus.get(os.path.realpath(instance.workspace))
+			if VagrantInstance.runningStates.get(raw_state) is False:
+				instance.setStateFromVagrantStatus(raw_state)
+				return True
+
 		status = self.runVagrant("status --machine-readable", instance, quiet = True)
 		if not status:
 			# We could fall back to using virsh directly...
 			raise ValueError("%s: vagrant status failed: %s" % (instance.name, status))
 
+		# We're only interested in the line that looks like
+		#  1638868423,default,state,running
+		marker = ",default,state,"
 		for line in status.output:
-			if not line:
+			if marker not in line:
 				continue
 
-			(ts, name, what, rest) = line.split(',', maxsplit = 3)
-			if what == 'state' and name == 'default':
-				instance.setStateFromVagrantStatus(rest)
+			(ts, sep, rest) = line.partition(marker)
+			instance.setStateFromVagrantStatus(unescapeMachineReadable(rest))
+			break
 
 		return True
 
@@ -523,10 +1069,21 @@ class VagrantBackend(Backend):
 			return
 
 		verbose("Stopping %s instance" % instance.name)
+		self.dropGlobalStatus()
 		status = self.runVagrant("halt", instance, timeout = 30)
 		if not status:
 			raise ValueError("%s: vagrant halt failed: %s" % (instance.name, status))
 
+		# A clean exit from "vagrant halt" is good enough for us. Only
+		# go back and ask "vagrant status" if we've been asked to force
+		# the issue, or if halt complained about something.
+		if not force and not self.haltOutputLooksSuspicious(status):
+			# This is what "vagrant status" would have told us,
+			# and it takes care of the network interfaces as well
+			instance.setStateFromVagrantStatus('shutoff')
+			instance.start_time = None
+			return True
+
 		self.detectInstanceState(instance)
 		if instance.running:
 			print("%s: vagrant halt failed to stop VM" % instance.name)
@@ -535,25 +1092,31 @@ class VagrantBackend(Backend):
 		instance.start_time = None
 		return True
 
+	def haltOutputLooksSuspicious(self, status):
+		for line in status.output:
+			if "WARNING" in line or "error" in line.lower():
+				return True
+		return False
+
 	def destroyInstance(self, instance):
 		verbose("Destroying %s instance" % instance.name)
+		self.dropGlobalStatus()
 		status = self.runVagrant("destroy -f", instance, timeout = 30)
 		if not status:
 			raise ValueError("%s: vagrant destroy failed: %s" % (instance.name, status))
 
-		shutil.rmtree(instance.workspace)
+		instance.removeWorkspace(executor = self.pool)
 		instance.dead = True
-		instance.exists = False
 
 		return True
 
 	def saveInstanceImage(self, instance, platform):
 		# It seems vagrant package --output does not like absolute path names...
 		imageFile = "%s.box" % platform.name
-		imagePath = os.path.join(instance.workspace, imageFile)
+		imagePath = instance.workspacePath(imageFile)
 
 		verbose("Writing image as %s" % imageFile)
-		cmd = "vagrant --machine-readable package --output %s" % imageFile
+		cmd = ["vagrant", "--machine-readable", "package", "--output", imageFile]
 		status = self.runShellCmd(cmd, cwd = instance.workspace, timeout = 120)
 		if not status:
 			raise ValueError("%s: vagrant package failed: %s" % (instance.name, status))
@@ -578,10 +1141,12 @@ class VagrantBackend(Backend):
 			]
 		}
 
-		metaPath = os.path.join(instance.workspace, "%s.json" % platform.name)
+		metaPath = instance.workspacePath("%s.json" % platform.name)
 		verbose("Writing image metadata as %s" % metaPath)
-		with open(metaPath, "w") as f:
-			json.dump(meta, f, indent = 4)
+		with open(metaPath, "wb") as f:
+			f.write(_json_dumps(meta))
+
+		self._metaCache.clear()
 
 		# Copy the json file from workspace to ~/.twopence/data/vagrant/
 		return platform.saveImage("vagrant", metaPath)
@@ -609,63 +1174,352 @@ class VagrantBackend(Backend):
 		if self.listing:
 			return self.listing
 
+		# Running "vagrant box list" is slow, so we cache its output
+		# across invocations for as long as the box directory does
+		# not change.
+		stamp = self.getBoxesTimestamp()
+		records = self.loadBoxListingCache(stamp)
+		if records is None:
+			records = self.runBoxList()
+			self.saveBoxListingCache(stamp, records)
+
+		self.listing = VagrantBoxListing()
+		for r in records:
+			self.listing.add(**r)
+
+		return self.listing
+
+	def runBoxList(self):
 		# vagrant --machine-readable box list
-		status = self.runShellCmd("vagrant box --machine-readable list", quiet = True)
+		# The output is parsed as vagrant produces it
+		status = self.runShellCmd(["vagrant", "box", "--machine-readable", "list"], quiet = True, stream = True)
+
+		records = []
+		current = None
+		try:
+			for row in csv.reader(status.output, quoting = csv.QUOTE_NONE):
+				if len(row) < 4:
+					continue
+
+				what = row[2]
+				if what == 'ui':
+					current = {}
+					records.append(current)
+					continue
+
+				field = _BoxListFields.get(what)
+				if field is not None:
+					current[field] = unescapeMachineReadable(','.join(row[3:]))
+		finally:
+			status.close()
+
 		if not status:
 			# We could fall back to using virsh directly...
 			raise ValueError("vagrant box list failed: %s" % (status))
 
-		self.listing = VagrantBoxListing()
-		current = None
-		for line in status.output:
-			if not line:
-				continue
+		return records
 
-			(ts, name, what, rest) = line.split(',', maxsplit = 3)
-			if what == 'ui':
-				current = self.listing.create()
-			elif what == 'box-name':
-				current.name = rest
-			elif what == 'box-version':
-				current.version = rest
-				# 0 means no version provided
-				if current.version == "0":
-					current.version = None
-			elif what == 'box-provider':
-				current.provider = rest
+	##################################################################
+	# Cache the box listing in ~/.twopence/cache.
+	# Adding a box creates a directory below ~/.vagrant.d/boxes, and
+	# adding a new version of an existing box creates a directory
+	# below ~/.vagrant.d/boxes/NAME, so the latest mtime of these
+	# tells us whether the cached listing is still good.
+	##################################################################
+	def getBoxesTimestamp(self):
+		vagrantHome = os.environ.get("VAGRANT_HOME") or "~/.vagrant.d"
+		path = os.path.join(os.path.expanduser(vagrantHome), "boxes")
 
-		return self.listing
+		try:
+			stamp = os.stat(path).st_mtime_ns
+			with os.scandir(path) as it:
+				for e in it:
+					if e.is_dir(follow_symlinks = False):
+						stamp = max(stamp, e.stat(follow_symlinks = False).st_mtime_ns)
+		except OSError:
+			return None
+
+		return stamp
+
+	def loadBoxListingCache(self, stamp):
+		if stamp is None:
+			return None
+
+		path = getCachePath(VagrantBoxListCache)
+		try:
+			with open(path, "rb") as f:
+				data = _json_loads(f.read())
+		except (OSError, ValueError):
+			return None
+
+		if data.get('mtime_ns') != stamp:
+			debug("Cached box listing %s is stale" % path)
+			return None
+
+		debug("Using cached box listing from %s" % path)
+		return data.get('boxes') or []
+
+	def saveBoxListingCache(self, stamp, records):
+		if stamp is None:
+			return
+
+		writeCacheFile(getCachePath(VagrantBoxListCache), {'mtime_ns': stamp, 'boxes': records})
+
+	def dropBoxListingCache(self):
+		try:
+			os.unlink(getCachePath(VagrantBoxListCache))
+		except FileNotFoundError:
+			pass
 
 	##################################################################
 	# Add a box from the given image
 	##################################################################
 	def addImage(self, box):
 		verbose("Adding vagrant box %s from %s" % (box, box.url))
-		cmd = "vagrant --no-tty box add --name \"%s\" --provider %s \"%s\"" % (box.name, box.provider, box.url)
+
+		url = box.url
+		plainHttp = url.startswith("http:") or url.startswith("https:")
+		if plainHttp:
+			url = self.downloadBoxToCache(url) or url
+
+		cmd = ["vagrant", "--no-tty", "box", "add", "--name", box.name, "--provider", box.provider]
+
+		# A box added from a plain http URL always ends up with version 0.
+		# For anything else, pin the version we want, as the meta data we
+		# got it from may be out of date, and vagrant would otherwise pick
+		# whatever upstream considers the latest version right now.
+		version = box.version
+		if plainHttp:
+			version = None
+		elif version is not None:
+			cmd += ["--box-version", version]
+
+		cmd.append(url)
 		if not self.runShellCmd(cmd, timeout = 60):
 			raise ValueError("Failed to add box %s from %s" % (box.name, box.url))
 
-		# Clear any cached listing
-		self.listing = None
+		# Rather than running "vagrant box list" again, add the new box
+		# to the listing we have, and update the cached listing.
+		# If we can't tell which version vagrant picked, start over with
+		# a fresh listing.
+		if self.listing is None or (version is None and not plainHttp):
+			self.dropBoxListingCache()
+			self.listing = None
+		else:
+			self.listing.add(name = box.name, version = version, provider = box.provider)
+			self.saveBoxListingCache(self.getBoxesTimestamp(), self.listing.getRecords())
+
+	##################################################################
+	# Boxes downloaded via http(s) are kept in ~/.twopence/cache/boxes,
+	# so that adding the same box again (eg after it was removed, or
+	# on a different VAGRANT_HOME) does not download it again.
+	# Next to each box (and each partial download), we keep its ETag and
+	# Last-Modified header, and revalidate the box with a conditional GET
+	# every time we use it, so that a URL like foo-latest.box does not
+	# serve the same old box forever.
+	# Returns the path of the cached box, or None if the download
+	# failed, in which case vagrant is left to download it itself.
+	##################################################################
+	def downloadBoxToCache(self, url):
+		digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+		path = getCachePath(VagrantBoxDownloadCache, digest + ".box")
+
+		try:
+			getHTTPSession()
+		except ImportError:
+			debug("python requests not available; leaving the download of %s to vagrant" % url)
+			return None
+
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok = True)
+
+			result = self.fetchBox(url, path)
+			if result == 'restart':
+				# The partial download we tried to resume is no good
+				result = self.fetchBox(url, path)
+		except OSError as e:
+			# this includes the exceptions raised by requests
+			warning("Failed to download %s: %s" % (url, e))
+			result = None
+
+		if result is None or result == 'restart':
+			if not os.path.isfile(path):
+				return None
+
+			warning("Using possibly stale cached download of %s" % url)
+
+		# Mark the box as recently used
+		os.utime(path)
+		self.pruneBoxDownloadCache(keep = path)
+		return path
+
+	# Returns 'cached' if the cached box is still good, 'downloaded'
+	# after downloading a new one, 'restart' if we should try again
+	# from scratch, and None on failure.
+	def fetchBox(self, url, path):
+		partPath = path + ".part"
+
+		boxInfo = None
+		if os.path.isfile(path):
+			boxInfo = self.loadDownloadInfo(path)
+
+		# Resume a previously interrupted download if there is one, but
+		# only if the server can tell us whether the file has changed since
+		offset = 0
+		partInfo = self.loadDownloadInfo(partPath)
+		validator = partInfo and (partInfo.get('etag') or partInfo.get('last_modified'))
+		if validator and os.path.isfile(partPath):
+			offset = os.path.getsize(partPath)
+
+		headers = {}
+		if offset:
+			headers['Range'] = "bytes=%d-" % offset
+			headers['If-Range'] = validator
+		elif boxInfo:
+			if boxInfo.get('etag'):
+				headers['If-None-Match'] = boxInfo['etag']
+			if boxInfo.get('last_modified'):
+				headers['If-Modified-Since'] = boxInfo['last_modified']
+
+		resp = getHTTPSession().get(url, headers = headers, stream = True, timeout = (10, 60))
+		with resp:
+			if resp.status_code == 304 and boxInfo is not None:
+				verbose("Cached download of %s is still valid" % url)
+				return 'cached'
+
+			if resp.status_code == 416:
+				debug("Cannot resume download of %s; starting over" % url)
+				self.removeBoxDownload(partPath)
+				return 'restart'
+
+			if not resp.ok:
+				warning("Failed to download %s: %s" % (url, resp.reason))
+				return None
+
+			info = {
+				'etag': resp.headers.get('etag'),
+				'last_modified': resp.headers.get('last-modified'),
+				'length': resp.headers.get('content-length'),
+			}
+
+			# Without validators, the best we can do is compare the size
+			if resp.status_code == 200 and boxInfo is not None and \
+			   not (info['etag'] or info['last_modified']) and \
+			   info['length'] is not None and info['length'] == boxInfo.get('length'):
+				verbose("Cached download of %s has the expected size; using it" % url)
+				return 'cached'
+
+			if resp.status_code == 206:
+				verbose("Resuming download of %s at offset %d" % (url, offset))
+				info = partInfo
+				mode = "ab"
+			else:
+				verbose("Downloading %s to %s" % (url, path))
+				writeCacheFile(partPath + ".json", info)
+				mode = "wb"
+
+			with open(partPath, mode) as f:
+				for chunk in resp.iter_content(chunk_size = 1024 * 1024):
+					f.write(chunk)
+
+		os.replace(partPath, path)
+		writeCacheFile(path + ".json", info)
+		self.removeBoxDownload(partPath)
+		return 'downloaded'
+
+	def loadDownloadInfo(self, path):
+		try:
+			with open(path + ".json", "rb") as f:
+				return _json_loads(f.read())
+		except (OSError, ValueError):
+			return None
+
+	def removeBoxDownload(self, path):
+		for name in (path, path + ".json"):
+			try:
+				os.unlink(name)
+			except FileNotFoundError:
+				pass
+
+	# vagrant box add copies the box to ~/.vagrant.d, so every box in our
+	# cache uses up its size twice. Keep the cache below box-cache-size
+	# by removing the least recently used boxes (and stale partial downloads).
+	def pruneBoxDownloadCache(self, keep = None):
+		cacheDir = getCachePath(VagrantBoxDownloadCache)
+		limit = (self.box_cache_size or VagrantBoxDownloadCacheSize) * 1024 * 1024
+
+		entries = []
+		try:
+			with os.scandir(cacheDir) as it:
+				for e in it:
+					if e.name.endswith(".box") or e.name.endswith(".box.part"):
+						st = e.stat()
+						entries.append((st.st_mtime, st.st_size, e.path))
+		except OSError:
+			return
+
+		total = sum(size for mtime, size, path in entries)
+		for mtime, size, path in sorted(entries):
+			if total <= limit:
+				break
+			if path == keep:
+				continue
+
+			debug("Removing %s from the box download cache" % path)
+			try:
+				self.removeBoxDownload(path)
+			except OSError as e:
+				warning("Unable to remove %s: %s" % (path, e))
+				continue
+			total -= size
 
 	##################################################################
 	# Run a vagrant command inside an instance workspace
 	##################################################################
-	def runVagrant(self, subcommand, instance, retries = 3, **kwargs):
-		for i in range(retries):
-			command = "vagrant "
-			if "--machine-readable" not in subcommand:
-				command += "--no-tty "
-			command += subcommand
+	def runVagrant(self, subcommand, instance, retries = None, **kwargs):
+		argv = ["vagrant"]
+		if "--machine-readable" not in subcommand:
+			argv.append("--no-tty")
+		argv += shlex.split(subcommand)
+
+		# Streamed output can only be consumed once, and that's up to the
+		# caller. We can neither check the outcome nor look for transient
+		# errors without eating the output, so don't retry in this case.
+		if kwargs.get('stream'):
+			return self.runShellCmd(argv, cwd = instance.workspace, **kwargs)
+
+		if retries is None:
+			retries = self.retries
+		retries = max(retries or 1, 1)
+
+		backoff = self.retry_backoff
+		if backoff is None:
+			backoff = 0.5
 
-			status = self.runShellCmd(command, cwd = instance.workspace, **kwargs)
+		for i in range(retries):
+			status = self.runShellCmd(argv, cwd = instance.workspace, **kwargs)
 			if status:
 				break
 
-			verbose("vagrant %s failed, retrying" % subcommand)
+			# Do not bother retrying if the error is not going to go away
+			if not self.isTransientFailure(status):
+				break
+
+			if i + 1 < retries:
+				verbose("vagrant %s failed, retrying" % subcommand)
+				time.sleep(backoff * (2 ** i))
 
 		return status
 
+	def isTransientFailure(self, status):
+		if status.how == status.TIMED_OUT:
+			return True
+
+		for line in status.output:
+			if any(p in line for p in _VagrantTransientErrors):
+				return True
+		return False
+
 	def runShellCmd(self, *args, **kwargs):
 		return self.runner.run(*args, **kwargs)
 